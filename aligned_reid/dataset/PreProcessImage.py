@@ -48,6 +48,19 @@ class PreProcessIm(object):
   def __call__(self, im):
     return self.pre_process_im(im)
 
+  def __getstate__(self):
+    """The default `prng`, the `np.random` module, can not be pickled (e.g.
+    when sent to DataLoader workers), so it is restored when unpickling."""
+    state = self.__dict__.copy()
+    if state['prng'] is np.random:
+      state['prng'] = None
+    return state
+
+  def __setstate__(self, state):
+    if state['prng'] is None:
+      state['prng'] = np.random
+    self.__dict__.update(state)
+
   @staticmethod
   def check_mirror_type(mirror_type):
     assert mirror_type in [None, 'random', 'always']
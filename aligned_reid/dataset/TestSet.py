@@ -4,6 +4,7 @@ import time
 import os.path as osp
 from PIL import Image
 import numpy as np
+import torch
 
 from .Dataset import Dataset
 
@@ -15,6 +16,8 @@ from ..utils.distance import normalize
 from ..utils.distance import compute_dist
 from ..utils.distance import local_dist
 from ..utils.distance import low_memory_matrix_op
+from ..model.loss import normalize as normalize_tensor
+from ..model.loss import euclidean_dist
 
 
 class TestSet(Dataset):
@@ -85,6 +88,8 @@ class TestSet(Dataset):
     Returns:
       global_feats: numpy array with shape [N, C]
       local_feats: numpy array with shape [N, H, c]
+      (If `extract_feat_func` returns pytorch tensors, the features are
+      pytorch tensors on the same device, instead of numpy arrays.)
       ids: numpy array with shape [N]
       cams: numpy array with shape [N]
       im_names: numpy array with shape [N]
@@ -122,15 +127,22 @@ class TestSet(Dataset):
                       time.time() - last_time, time.time() - st))
         last_time = time.time()
 
-    global_feats = np.vstack(global_feats)
-    local_feats = np.concatenate(local_feats)
     ids = np.hstack(ids)
     cams = np.hstack(cams)
     im_names = np.hstack(im_names)
     marks = np.hstack(marks)
-    if normalize_feat:
-      global_feats = normalize(global_feats, axis=1)
-      local_feats = normalize(local_feats, axis=-1)
+    if torch.is_tensor(global_feats[0]):
+      global_feats = torch.cat(global_feats)
+      local_feats = torch.cat(local_feats)
+      if normalize_feat:
+        global_feats = normalize_tensor(global_feats, axis=1)
+        local_feats = normalize_tensor(local_feats, axis=-1)
+    else:
+      global_feats = np.vstack(global_feats)
+      local_feats = np.concatenate(local_feats)
+      if normalize_feat:
+        global_feats = normalize(global_feats, axis=1)
+        local_feats = normalize(local_feats, axis=-1)
     return global_feats, local_feats, ids, cams, im_names, marks
 
   @staticmethod
@@ -192,6 +204,26 @@ class TestSet(Dataset):
     g_inds = marks == 1
     mq_inds = marks == 2
 
+    # Local distance is computed with numpy.
+    if use_local_distance and torch.is_tensor(local_feats):
+      local_feats = local_feats.cpu().numpy()
+
+    # A helper function just for avoiding code duplication.
+    def global_dist(x_inds, y_inds):
+      if not torch.is_tensor(global_feats):
+        return compute_dist(
+          global_feats[x_inds], global_feats[y_inds], type='euclidean')
+      # Compute on the device of the features, only transfer the result. Rows
+      # are computed in chunks, so that large matrices (e.g. gallery-gallery
+      # for re-ranking) don't flood the device memory.
+      x, y = [
+        global_feats[
+          torch.from_numpy(np.flatnonzero(inds)).to(global_feats.device)]
+        for inds in [x_inds, y_inds]]
+      return np.concatenate(
+        [euclidean_dist(part_x, y).cpu().numpy()
+         for part_x in torch.split(x, 1000)])
+
     # A helper function just for avoiding code duplication.
     def compute_score(dist_mat):
       mAP, cmc_scores = self.eval_map_cmc(
@@ -219,8 +251,7 @@ class TestSet(Dataset):
 
     with measure_time('Computing global distance...'):
       # query-gallery distance using global distance
-      global_q_g_dist = compute_dist(
-        global_feats[q_inds], global_feats[g_inds], type='euclidean')
+      global_q_g_dist = global_dist(q_inds, g_inds)
 
     with measure_time('Computing scores for Global Distance...'):
       mAP, cmc_scores = compute_score(global_q_g_dist)
@@ -228,12 +259,10 @@ class TestSet(Dataset):
     if to_re_rank:
       with measure_time('Re-ranking...'):
         # query-query distance using global distance
-        global_q_q_dist = compute_dist(
-          global_feats[q_inds], global_feats[q_inds], type='euclidean')
+        global_q_q_dist = global_dist(q_inds, q_inds)
 
         # gallery-gallery distance using global distance
-        global_g_g_dist = compute_dist(
-          global_feats[g_inds], global_feats[g_inds], type='euclidean')
+        global_g_g_dist = global_dist(g_inds, g_inds)
 
         # re-ranked global query-gallery distance
         re_r_global_q_g_dist = re_ranking(
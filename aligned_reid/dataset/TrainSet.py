@@ -5,6 +5,90 @@ import os.path as osp
 from PIL import Image
 import numpy as np
 from collections import defaultdict
+import torch
+from torch.utils.data import DataLoader
+from torch.utils.data import Dataset as TorchDataset
+from torch.utils.data.distributed import DistributedSampler
+
+
+def collate_ids(samples):
+  """Concatenate the images and labels of several ids into a batch.
+  Returns:
+    ims: a float tensor with shape [N, C, H, W] (or [N, H, W, C])
+    labels: a long tensor with shape [N]
+  """
+  ims, labels = zip(*samples)
+  return torch.from_numpy(np.concatenate(ims)).float(), \
+         torch.from_numpy(np.concatenate(labels)).long()
+
+
+def seed_worker(worker_id):
+  """Give each loader worker its own numpy random state, derived from the
+  torch seed of the worker, so that workers do not repeat each other's
+  sampling and augmentation."""
+  info = torch.utils.data.get_worker_info()
+  seed = info.seed % 2 ** 32
+  np.random.seed(seed)
+  prng = info.dataset.pre_process_im.prng
+  if isinstance(prng, np.random.RandomState):
+    prng.seed(seed)
+
+
+class TrainIdSet(TorchDataset):
+  """The sampling part of `TrainSet` as a torch Dataset, each item being the
+  images and labels of one id. It only holds what sampling needs, so that it
+  can be pickled to DataLoader workers under any start method.
+  Args:
+    ids: a list of ids
+    ids_to_im_inds: a dict mapping ids to indices of `im_names`
+    pre_process_im: a `PreProcessIm` object
+  """
+
+  def __init__(
+      self,
+      im_dir,
+      im_names,
+      ids,
+      ids_to_im_inds,
+      ids2labels,
+      ims_per_id,
+      pre_process_im):
+    self.im_dir = im_dir
+    self.im_names = im_names
+    self.ids = list(ids)
+    self.ids_to_im_inds = dict(ids_to_im_inds)
+    self.ids2labels = ids2labels
+    self.ims_per_id = ims_per_id
+    self.pre_process_im = pre_process_im
+
+  def get_id_sample(self, id):
+    """Several images (and labels etc) of one id.
+    Returns:
+      ims: a list of images
+    """
+    inds = self.ids_to_im_inds[id]
+    if len(inds) < self.ims_per_id:
+      inds = np.random.choice(inds, self.ims_per_id, replace=True)
+    else:
+      inds = np.random.choice(inds, self.ims_per_id, replace=False)
+    im_names = [self.im_names[ind] for ind in inds]
+    ims = [np.asarray(Image.open(osp.join(self.im_dir, name)))
+           for name in im_names]
+    ims, mirrored = zip(*[self.pre_process_im(im) for im in ims])
+    labels = [self.ids2labels[id] for _ in range(self.ims_per_id)]
+    return ims, im_names, labels, mirrored
+
+  def __len__(self):
+    return len(self.ids)
+
+  def __getitem__(self, ptr):
+    """
+    Returns:
+      ims: numpy array with shape [ims_per_id, C, H, W] or [ims_per_id, H, W, C]
+      labels: numpy array with shape [ims_per_id]
+    """
+    ims, im_names, labels, mirrored = self.get_id_sample(self.ids[ptr])
+    return np.stack(ims), np.array(labels)
 
 
 class TrainSet(Dataset):
@@ -33,29 +117,73 @@ class TrainSet(Dataset):
     self.ids_to_im_inds = defaultdict(list)
     for ind, id in enumerate(im_ids):
       self.ids_to_im_inds[id].append(ind)
-    self.ids = self.ids_to_im_inds.keys()
+    # A sorted list, so that it can be indexed, and is the same in each run.
+    self.ids = sorted(self.ids_to_im_inds.keys())
 
     super(TrainSet, self).__init__(
       dataset_size=len(self.ids),
       batch_size=ids_per_batch,
       **kwargs)
 
+    # `self.ids` is shuffled in place by `next_batch`, the copy is not.
+    self.id_set = TrainIdSet(
+      im_dir=im_dir,
+      im_names=im_names,
+      ids=self.ids,
+      ids_to_im_inds=self.ids_to_im_inds,
+      ids2labels=ids2labels,
+      ims_per_id=ims_per_id,
+      pre_process_im=self.pre_process_im)
+
   def get_sample(self, ptr):
     """Here one sample means several images (and labels etc) of one id.
     Returns:
       ims: a list of images
     """
-    inds = self.ids_to_im_inds[self.ids[ptr]]
-    if len(inds) < self.ims_per_id:
-      inds = np.random.choice(inds, self.ims_per_id, replace=True)
-    else:
-      inds = np.random.choice(inds, self.ims_per_id, replace=False)
-    im_names = [self.im_names[ind] for ind in inds]
-    ims = [np.asarray(Image.open(osp.join(self.im_dir, name)))
-           for name in im_names]
-    ims, mirrored = zip(*[self.pre_process_im(im) for im in ims])
-    labels = [self.ids2labels[self.ids[ptr]] for _ in range(self.ims_per_id)]
-    return ims, im_names, labels, mirrored
+    return self.id_set.get_id_sample(self.ids[ptr])
+
+  def get_loader(self, num_workers=4, pin_memory=True, prefetch_factor=4,
+                 num_replicas=1, rank=0):
+    """A DataLoader loading batches in worker processes, instead of the
+    prefetching threads used by `next_batch`. Each batch has `ids_per_batch`
+    ids, and `ims_per_id` images for each id. The loader is built on
+    `self.id_set`, which, unlike this object with its prefetching threads, can
+    be pickled to workers started by spawn or forkserver.
+    Args:
+      num_workers: number of worker processes, 0 means loading in the main
+        process
+      pin_memory: whether to put the batches in pinned memory, for faster
+        copying to gpu
+      prefetch_factor: number of batches loaded in advance by each worker
+      num_replicas: number of processes in distributed training
+      rank: rank of the current process; in each epoch, the process samples
+        from its own part of the ids, disjoint from that of other processes.
+        Call `loader.sampler.set_epoch(ep)` at each epoch to repartition the
+        ids.
+    Returns:
+      a DataLoader yielding (ims, labels) tensors as returned by `collate_ids`
+    """
+    kwargs = dict()
+    if num_workers > 0:
+      kwargs = dict(persistent_workers=True,
+                    prefetch_factor=prefetch_factor,
+                    worker_init_fn=seed_worker)
+    sampler = None
+    if num_replicas > 1:
+      # Pads the ids to be evenly divisible, so that all processes run the
+      # same number of steps in an epoch.
+      sampler = DistributedSampler(
+        self.id_set, num_replicas=num_replicas, rank=rank, shuffle=self.shuffle)
+    return DataLoader(
+      self.id_set,
+      batch_size=self.ids_per_batch,
+      shuffle=self.shuffle and (sampler is None),
+      sampler=sampler,
+      num_workers=num_workers,
+      collate_fn=collate_ids,
+      pin_memory=pin_memory,
+      drop_last=not self.prefetcher.final_batch,
+      **kwargs)
 
   def next_batch(self):
     """Next batch of images and labels.
@@ -17,8 +17,8 @@ class Model(nn.Module):
 
     if num_classes is not None:
       self.fc = nn.Linear(planes, num_classes)
-      init.normal(self.fc.weight, std=0.001)
-      init.constant(self.fc.bias, 0)
+      init.normal_(self.fc.weight, std=0.001)
+      init.constant_(self.fc.bias, 0)
 
   def forward(self, x):
     """
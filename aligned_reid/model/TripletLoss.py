@@ -1,5 +1,5 @@
+import torch
 from torch import nn
-from torch.autograd import Variable
 
 
 class TripletLoss(object):
@@ -23,7 +23,7 @@ class TripletLoss(object):
     Returns:
       loss: pytorch Variable, with shape [1]
     """
-    y = Variable(dist_an.data.new().resize_as_(dist_an.data).fill_(1))
+    y = torch.ones_like(dist_an)
     if self.margin is not None:
       loss = self.ranking_loss(dist_an, dist_ap, y)
     else:
@@ -25,7 +25,7 @@ def euclidean_dist(x, y):
   xx = torch.pow(x, 2).sum(1, keepdim=True).expand(m, n)
   yy = torch.pow(y, 2).sum(1, keepdim=True).expand(n, m).t()
   dist = xx + yy
-  dist.addmm_(1, -2, x, y.t())
+  dist.addmm_(x, y.t(), beta=1, alpha=-2)
   dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
   return dist
 
@@ -50,7 +50,7 @@ def batch_euclidean_dist(x, y):
   xx = torch.pow(x, 2).sum(-1, keepdim=True).expand(N, m, n)
   yy = torch.pow(y, 2).sum(-1, keepdim=True).expand(N, n, m).permute(0, 2, 1)
   dist = xx + yy
-  dist.baddbmm_(1, -2, x, y.permute(0, 2, 1))
+  dist.baddbmm_(x, y.permute(0, 2, 1), beta=1, alpha=-2)
   dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
   return dist
 
@@ -128,6 +128,20 @@ def batch_local_dist(x, y):
   return dist
 
 
+@torch.jit.script
+def sum_squared_diff(x, y):
+  """Scripted, so that subtraction, multiplication and sum can be fused into
+  fewer kernels.
+  Args:
+    x: pytorch Variable, e.g. with shape [N, N]
+    y: pytorch Variable, broadcastable with `x`, e.g. with shape [M, N, N]
+  Returns:
+    dist: pytorch Variable, sum of squared differences; scalar
+  """
+  diff = x - y
+  return (diff * diff).sum()
+
+
 def hard_example_mining(dist_mat, labels, return_inds=False):
   """For each anchor, find the hardest positive and negative sample.
   Args:
@@ -167,14 +181,12 @@ def hard_example_mining(dist_mat, labels, return_inds=False):
 
   if return_inds:
     # shape [N, N]
-    ind = (labels.new().resize_as_(labels)
-           .copy_(torch.arange(0, N).long())
-           .unsqueeze( 0).expand(N, N))
+    ind = torch.arange(N, device=labels.device).unsqueeze(0).expand(N, N)
     # shape [N, 1]
     p_inds = torch.gather(
-      ind[is_pos].contiguous().view(N, -1), 1, relative_p_inds.data)
+      ind[is_pos].contiguous().view(N, -1), 1, relative_p_inds)
     n_inds = torch.gather(
-      ind[is_neg].contiguous().view(N, -1), 1, relative_n_inds.data)
+      ind[is_neg].contiguous().view(N, -1), 1, relative_n_inds)
     # shape [N]
     p_inds = p_inds.squeeze(1)
     n_inds = n_inds.squeeze(1)
@@ -207,6 +219,8 @@ def global_loss(tri_loss, global_feat, labels, normalize_feature=True):
     ===================
     dist_mat: pytorch Variable, pairwise euclidean distance; shape [N, N]
   """
+  # Compute distance in float32, also under mixed precision.
+  global_feat = global_feat.float()
   if normalize_feature:
     global_feat = normalize(global_feat, axis=-1)
   # shape [N, N]
@@ -252,6 +266,8 @@ def local_loss(
     ===================
     dist_mat: pytorch Variable, pairwise local distance; shape [N, N]
   """
+  # Compute distance in float32, also under mixed precision.
+  local_feat = local_feat.float()
   if normalize_feature:
     local_feat = normalize(local_feat, axis=-1)
   if p_inds is None or n_inds is None:
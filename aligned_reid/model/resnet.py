@@ -109,10 +109,10 @@ class ResNet(nn.Module):
     for m in self.modules():
       if isinstance(m, nn.Conv2d):
         n = m.kernel_size[0] * m.kernel_size[1] * m.out_channels
-        m.weight.data.normal_(0, math.sqrt(2. / n))
+        nn.init.normal_(m.weight, 0, math.sqrt(2. / n))
       elif isinstance(m, nn.BatchNorm2d):
-        m.weight.data.fill_(1)
-        m.bias.data.zero_()
+        nn.init.constant_(m.weight, 1)
+        nn.init.zeros_(m.bias)
 
   def _make_layer(self, block, planes, blocks, stride=1):
     downsample = None
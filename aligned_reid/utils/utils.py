@@ -1,14 +1,15 @@
 from __future__ import print_function
 import os
 import os.path as osp
-import cPickle as pickle
+import pickle
 from scipy import io
 import datetime
 import time
 from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import atexit
 
 import torch
-from torch.autograd import Variable
 
 
 def time_str(fmt=None):
@@ -19,8 +20,9 @@ def time_str(fmt=None):
 
 def load_pickle(path):
   """Check and load pickle object.
-  According to this post: https://stackoverflow.com/a/41733927, cPickle and 
-  disabling garbage collector helps with loading speed."""
+  According to this post: https://stackoverflow.com/a/41733927, cPickle (the
+  C implementation used by `pickle` in Python 3) and disabling garbage
+  collector helps with loading speed."""
   assert osp.exists(path)
   # gc.disable()
   with open(path, 'rb') as f:
@@ -42,14 +44,12 @@ def save_mat(ndarray, path):
 
 
 def to_scalar(vt):
-  """Transform a length-1 pytorch Variable or Tensor to scalar. 
+  """Transform a length-1 pytorch Tensor to scalar. 
   Suppose tx is a torch Tensor with shape tx.size() = torch.Size([1]), 
   then npx = tx.cpu().numpy() has shape (1,), not 1."""
-  if isinstance(vt, Variable):
-    return vt.data.cpu().numpy().flatten()[0]
   if torch.is_tensor(vt):
-    return vt.cpu().numpy().flatten()[0]
-  raise TypeError('Input should be a variable or tensor')
+    return vt.detach().cpu().numpy().flatten()[0]
+  raise TypeError('Input should be a tensor')
 
 
 def transfer_optim_state(state, device_id=-1):
@@ -63,8 +63,6 @@ def transfer_optim_state(state, device_id=-1):
   for key, val in state.items():
     if isinstance(val, dict):
       transfer_optim_state(val, device_id=device_id)
-    elif isinstance(val, Variable):
-      raise RuntimeError("Oops, state[{}] is a Variable!".format(key))
     elif isinstance(val, torch.nn.Parameter):
       raise RuntimeError("Oops, state[{}] is a Parameter!".format(key))
     else:
@@ -120,6 +118,49 @@ class TransferVarTensor(object):
       else var_or_tensor.cuda(self.device_id)
 
 
+class DevicePrefetcher(object):
+  """Iterate over batches of cpu tensors, and copy them to the gpu. The next
+  batch is copied from pinned memory on a side CUDA stream while the current
+  batch is being consumed, so that the copy overlaps with computation.
+  Args:
+    batches: an iterable, each element being a tuple of cpu tensors
+    device_id: gpu id, or -1 which means keeping the tensors on cpu
+  """
+
+  def __init__(self, batches, device_id=-1):
+    self.batches = batches
+    self.device_id = device_id
+
+  def __iter__(self):
+    if self.device_id == -1:
+      for batch in self.batches:
+        yield batch
+      return
+    stream = torch.cuda.Stream(device=self.device_id)
+    batches = iter(self.batches)
+    next_batch = self._copy(batches, stream)
+    while next_batch is not None:
+      current_stream = torch.cuda.current_stream(self.device_id)
+      current_stream.wait_stream(stream)
+      batch = next_batch
+      # The memory is allocated on the side stream but used on current stream.
+      for t in batch:
+        t.record_stream(current_stream)
+      next_batch = self._copy(batches, stream)
+      yield batch
+
+  def _copy(self, batches, stream):
+    try:
+      batch = next(batches)
+    except StopIteration:
+      return None
+    with torch.cuda.stream(stream):
+      return tuple(
+        (t if t.is_pinned() else t.pin_memory())
+          .cuda(self.device_id, non_blocking=True)
+        for t in batch)
+
+
 class TransferModulesOptims(object):
   """Transfer optimizers/modules to cpu or specified gpu."""
 
@@ -264,6 +305,63 @@ def save_ckpt(modules_optims, ep, scores, ckpt_file):
   torch.save(ckpt, ckpt_file)
 
 
+def copy_to_cpu(obj):
+  """Copy the tensors in a (possibly nested) dict, list or tuple to cpu.
+  Tensors already on cpu are copied as well."""
+  if torch.is_tensor(obj):
+    return obj.detach().to('cpu', copy=True)
+  if isinstance(obj, dict):
+    ret = type(obj)((k, copy_to_cpu(v)) for k, v in obj.items())
+    # The version info of modules, used by `Module.load_state_dict`.
+    if hasattr(obj, '_metadata'):
+      ret._metadata = obj._metadata
+    return ret
+  if isinstance(obj, (list, tuple)):
+    return type(obj)(copy_to_cpu(v) for v in obj)
+  return obj
+
+
+class AsyncCkptSaver(object):
+  """Save checkpoints like `save_ckpt`, but write them to disk on a
+  background thread, so that training goes on meanwhile. The state_dict's are
+  copied to cpu before returning, since the parameters keep changing. The
+  file is written to a temporary path and then renamed, so that `ckpt_file`
+  is never left half written."""
+
+  def __init__(self):
+    self.executor = ThreadPoolExecutor(max_workers=1)
+    self.future = None
+    # Finish pending saving when the program exits.
+    atexit.register(self.close)
+
+  def save(self, modules_optims, ep, scores, ckpt_file):
+    state_dicts = [copy_to_cpu(m.state_dict()) for m in modules_optims]
+    ckpt = dict(state_dicts=state_dicts,
+                ep=ep,
+                scores=scores)
+    # At most one checkpoint is being written, to bound the memory. This also
+    # raises the error of the last saving, if any.
+    self.wait()
+    self.future = self.executor.submit(self._write, ckpt, ckpt_file)
+
+  @staticmethod
+  def _write(ckpt, ckpt_file):
+    may_make_dir(osp.dirname(osp.abspath(ckpt_file)))
+    tmp_file = ckpt_file + '.tmp'
+    torch.save(ckpt, tmp_file)
+    os.replace(tmp_file, ckpt_file)
+
+  def wait(self):
+    """Block until the pending saving is finished."""
+    if self.future is not None:
+      self.future.result()
+      self.future = None
+
+  def close(self):
+    self.executor.shutdown(wait=True)
+    self.wait()
+
+
 def load_state_dict(model, src_state_dict):
   """Copy parameters and buffers from `src_state_dict` into `model` and its 
   descendants. The `src_state_dict.keys()` NEED NOT exactly match 
@@ -285,10 +383,10 @@ def load_state_dict(model, src_state_dict):
       continue
     if isinstance(param, Parameter):
       # backwards compatibility for serialized parameters
-      param = param.data
+      param = param.detach()
     try:
       dest_state_dict[name].copy_(param)
-    except Exception, msg:
+    except Exception as msg:
       print("Warning: Error occurs when copying '{}': {}"
             .format(name, str(msg)))
 
@@ -340,25 +438,28 @@ def may_make_dir(path):
 
 class AverageMeter(object):
   """Modified from Tong Xiao's open-reid. 
-  Computes and stores the average and current value"""
+  Computes and stores the average and current value. The value can also be a
+  zero-dim tensor, which is summed up on its device; it is not transferred to
+  host until `avg` is accessed, so that updating does not synchronize."""
 
   def __init__(self):
     self.val = 0
-    self.avg = 0
     self.sum = 0
     self.count = 0
 
   def reset(self):
     self.val = 0
-    self.avg = 0
     self.sum = 0
     self.count = 0
 
   def update(self, val, n=1):
     self.val = val
-    self.sum += val * n
+    self.sum = self.sum + val * n
     self.count += n
-    self.avg = float(self.sum) / (self.count + 1e-20)
+
+  @property
+  def avg(self):
+    return float(self.sum) / (self.count + 1e-20)
 
 
 class RunningAverageMeter(object):
@@ -498,8 +599,11 @@ def set_seed(seed):
   print('setting np-random-seed to {}'.format(seed))
 
   import torch
-  torch.backends.cudnn.enabled = False
-  print('cudnn.enabled set to {}'.format(torch.backends.cudnn.enabled))
+  # Deterministic cudnn algorithms, instead of disabling cudnn.
+  torch.backends.cudnn.benchmark = False
+  torch.backends.cudnn.deterministic = True
+  print('cudnn.deterministic set to {}'.format(
+    torch.backends.cudnn.deterministic))
   # set seed for CPU
   torch.manual_seed(seed)
   print('setting torch-seed to {}'.format(seed))
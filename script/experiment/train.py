@@ -5,12 +5,14 @@ import sys
 sys.path.insert(0, '.')
 
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.optim as optim
+import torch.distributed as dist
 from torch.nn.parallel import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 
 import time
+import os
 import os.path as osp
 from tensorboardX import SummaryWriter
 import numpy as np
@@ -28,10 +30,12 @@ from aligned_reid.utils.utils import tight_float_str as tfs
 from aligned_reid.utils.utils import may_set_mode
 from aligned_reid.utils.utils import load_state_dict
 from aligned_reid.utils.utils import load_ckpt
-from aligned_reid.utils.utils import save_ckpt
+from aligned_reid.utils.utils import AsyncCkptSaver
 from aligned_reid.utils.utils import set_devices
+from aligned_reid.utils.utils import TransferVarTensor
+from aligned_reid.utils.utils import TransferModulesOptims
+from aligned_reid.utils.utils import DevicePrefetcher
 from aligned_reid.utils.utils import AverageMeter
-from aligned_reid.utils.utils import to_scalar
 from aligned_reid.utils.utils import ReDirectSTD
 from aligned_reid.utils.utils import set_seed
 from aligned_reid.utils.utils import adjust_lr_exp
@@ -43,6 +47,9 @@ class Config(object):
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--sys_device_ids', type=eval, default=(0,))
+    # Set by `torch.distributed.launch`; `torchrun` sets env `LOCAL_RANK`.
+    parser.add_argument('--local_rank', type=int,
+                        default=int(os.environ.get('LOCAL_RANK', 0)))
     parser.add_argument('-r', '--run', type=int, default=1)
     parser.add_argument('--set_seed', type=str2bool, default=False)
     parser.add_argument('--dataset', type=str, default='market1501',
@@ -81,12 +88,21 @@ class Config(object):
     parser.add_argument('--staircase_decay_multiply_factor',
                         type=float, default=0.1)
     parser.add_argument('--total_epochs', type=int, default=150)
+    parser.add_argument('--amp', type=str2bool, default=False)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--compile_loss', type=str2bool, default=False)
 
     args = parser.parse_known_args()[0]
 
     # gpu ids
     self.sys_device_ids = args.sys_device_ids
 
+    # Launched by `torch.distributed.launch` or `torchrun`, one process per
+    # GPU. In this case `sys_device_ids` is ignored, each process uses GPU
+    # `local_rank`, and `ids_per_batch` is the number of ids for EACH process.
+    self.distributed = int(os.environ.get('WORLD_SIZE', 1)) > 1
+    self.local_rank = args.local_rank
+
     if args.set_seed:
       self.seed = 1
     else:
@@ -107,6 +123,9 @@ class Config(object):
     else:
       self.prefetch_threads = 2
 
+    # Number of worker processes loading the training batches.
+    self.num_workers = args.num_workers
+
     self.dataset = args.dataset
     self.trainset_part = args.trainset_part
 
@@ -204,10 +223,24 @@ class Config(object):
     # Number of epochs to train
     self.total_epochs = args.total_epochs
 
+    # Whether to use mixed precision (only on GPU) in forward and backward.
+    # Off by default; the scores reported in README are trained without it.
+    self.amp = args.amp \
+      and (self.distributed or len(self.sys_device_ids) > 0)
+
+    # Whether to compile the losses with `torch.compile`, which fuses the
+    # many small ops after the backbone. Compiling takes some minutes at the
+    # first steps.
+    self.compile_loss = args.compile_loss
+
     # How often (in batches) to log. If only need to log the average
     # information for each epoch, set this to a large value, e.g. 1e10.
     self.log_steps = 1e10
 
+    # How often (in epochs) to flush TensorBoard events to disk. Between
+    # flushes, the writer also flushes by itself every two minutes.
+    self.tb_flush_epochs = 10
+
     # Only test and without training.
     self.only_test = args.only_test
 
@@ -262,7 +295,8 @@ class Config(object):
 
 
 class ExtractFeature(object):
-  """A function to be called in the val/test set, to extract features.
+  """A function to be called in the val/test set, to extract features. The
+  features are returned as tensors on the device of the model.
   Args:
     TVT: A callable to transfer images to specific device.
   """
@@ -277,10 +311,9 @@ class ExtractFeature(object):
     # Force all BN layers to use global mean and variance, also disable
     # dropout.
     self.model.eval()
-    ims = Variable(self.TVT(torch.from_numpy(ims).float()))
-    global_feat, local_feat = self.model(ims)[:2]
-    global_feat = global_feat.data.cpu().numpy()
-    local_feat = local_feat.data.cpu().numpy()
+    ims = self.TVT(torch.from_numpy(ims).float())
+    with torch.no_grad():
+      global_feat, local_feat = self.model(ims)[:2]
     # Restore the model to its old train/eval mode.
     self.model.train(old_train_eval_model)
     return global_feat, local_feat
@@ -289,42 +322,68 @@ class ExtractFeature(object):
 def main():
   cfg = Config()
 
+  if cfg.distributed:
+    dist.init_process_group(backend='nccl')
+    torch.cuda.set_device(cfg.local_rank)
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+  else:
+    rank = 0
+    world_size = 1
+  # Only the main process logs, saves checkpoint and tests.
+  is_main_process = rank == 0
+
   # Redirect logs to both console and file.
-  if cfg.log_to_file:
+  if cfg.log_to_file and is_main_process:
     ReDirectSTD(cfg.stdout_file, 'stdout', False)
     ReDirectSTD(cfg.stderr_file, 'stderr', False)
 
   # Lazily create SummaryWriter
   writer = None
 
-  TVT, TMO = set_devices(cfg.sys_device_ids)
+  if cfg.distributed:
+    TVT = TransferVarTensor(cfg.local_rank)
+    TMO = TransferModulesOptims(cfg.local_rank)
+  else:
+    TVT, TMO = set_devices(cfg.sys_device_ids)
 
   if cfg.seed is not None:
     set_seed(cfg.seed)
+  else:
+    # The input size is fixed, so let cudnn pick the fastest algorithms.
+    torch.backends.cudnn.benchmark = True
 
   # Dump the configurations to log.
-  import pprint
-  print('-' * 60)
-  print('cfg.__dict__')
-  pprint.pprint(cfg.__dict__)
-  print('-' * 60)
+  if is_main_process:
+    import pprint
+    print('-' * 60)
+    print('cfg.__dict__')
+    pprint.pprint(cfg.__dict__)
+    print('-' * 60)
 
   ###########
   # Dataset #
   ###########
 
   train_set = create_dataset(**cfg.train_set_kwargs)
+  # Each process draws its batches from a disjoint part of the ids.
+  train_loader = train_set.get_loader(
+    num_workers=cfg.num_workers, pin_memory=TVT.device_id != -1,
+    num_replicas=world_size, rank=rank)
+  # The loader takes the place of the prefetching threads.
+  train_set.stop_prefetching_threads()
 
   test_sets = []
   test_set_names = []
-  if cfg.dataset == 'combined':
-    for name in ['market1501', 'cuhk03', 'duke']:
-      cfg.test_set_kwargs['name'] = name
+  if is_main_process:
+    if cfg.dataset == 'combined':
+      for name in ['market1501', 'cuhk03', 'duke']:
+        cfg.test_set_kwargs['name'] = name
+        test_sets.append(create_dataset(**cfg.test_set_kwargs))
+        test_set_names.append(name)
+    else:
       test_sets.append(create_dataset(**cfg.test_set_kwargs))
-      test_set_names.append(name)
-  else:
-    test_sets.append(create_dataset(**cfg.test_set_kwargs))
-    test_set_names.append(cfg.dataset)
+      test_set_names.append(cfg.dataset)
 
   ###########
   # Models  #
@@ -332,8 +391,6 @@ def main():
 
   model = Model(local_conv_out_channels=cfg.local_conv_out_channels,
                 num_classes=len(train_set.ids2labels))
-  # Model wrapper
-  model_w = DataParallel(model)
 
   #############################
   # Criteria and Optimizers   #
@@ -361,6 +418,18 @@ def main():
   # is to cope with the case when you load the checkpoint to a new device.
   TMO(modules_optims)
 
+  # Model wrapper
+  if cfg.distributed:
+    # Gradients are all-reduced across processes during `backward()`.
+    # The local branch and the classifier get no gradient when their losses
+    # are disabled, which DDP has to be told about.
+    model_w = DistributedDataParallel(
+      model, device_ids=[cfg.local_rank], output_device=cfg.local_rank,
+      find_unused_parameters=(cfg.l_loss_weight == 0)
+                             or (cfg.id_loss_weight == 0))
+  else:
+    model_w = DataParallel(model)
+
   ########
   # Test #
   ########
@@ -378,21 +447,65 @@ def main():
     use_local_distance = (cfg.l_loss_weight > 0) \
                          and cfg.local_dist_own_hard_sample
 
+    # The DDP wrapper would wait for other processes in forward, while only
+    # the main process tests.
+    feat_model = model if cfg.distributed else model_w
     for test_set, name in zip(test_sets, test_set_names):
-      test_set.set_feat_func(ExtractFeature(model_w, TVT))
+      test_set.set_feat_func(ExtractFeature(feat_model, TVT))
       print('\n=========> Test on dataset: {} <=========\n'.format(name))
       test_set.eval(
         normalize_feat=cfg.normalize_feature,
         use_local_distance=use_local_distance)
 
   if cfg.only_test:
-    test(load_model_weight=True)
+    if is_main_process:
+      test(load_model_weight=True)
     return
 
   ############
   # Training #
   ############
 
+  def compute_loss(global_feat, local_feat, logits, labels_t):
+    """Returns the total loss, the separate losses, and the distances
+    required by step log."""
+    g_loss, p_inds, n_inds, g_dist_ap, g_dist_an, g_dist_mat = global_loss(
+      g_tri_loss, global_feat, labels_t,
+      normalize_feature=cfg.normalize_feature)
+
+    if cfg.l_loss_weight == 0:
+      l_loss, l_dist_ap, l_dist_an = 0, None, None
+    elif cfg.local_dist_own_hard_sample:
+      # Let local distance find its own hard samples.
+      l_loss, l_dist_ap, l_dist_an, _ = local_loss(
+        l_tri_loss, local_feat, None, None, labels_t,
+        normalize_feature=cfg.normalize_feature)
+    else:
+      l_loss, l_dist_ap, l_dist_an = local_loss(
+        l_tri_loss, local_feat, p_inds, n_inds, labels_t,
+        normalize_feature=cfg.normalize_feature)
+
+    id_loss = 0
+    if cfg.id_loss_weight > 0:
+      id_loss = id_criterion(logits, labels_t)
+
+    loss = g_loss * cfg.g_loss_weight \
+           + l_loss * cfg.l_loss_weight \
+           + id_loss * cfg.id_loss_weight
+
+    return loss, g_loss, l_loss, id_loss, \
+           g_dist_ap, g_dist_an, l_dist_ap, l_dist_an
+
+  if cfg.compile_loss:
+    # The model (and its DDP wrapper) stays outside the compiled region.
+    compute_loss = torch.compile(compute_loss, mode='max-autotune')
+
+  # Scales the loss to avoid underflow of half precision gradients.
+  scaler = torch.cuda.amp.GradScaler(enabled=cfg.amp)
+
+  # Checkpoints are written to disk while the next epoch is running.
+  ckpt_saver = AsyncCkptSaver()
+
   start_ep = resume_ep if cfg.resume else 0
   for ep in range(start_ep, cfg.total_epochs):
 
@@ -414,6 +527,11 @@ def main():
 
     may_set_mode(modules_optims, 'train')
 
+    if cfg.distributed:
+      # All processes shuffle the ids with the same seed in each epoch, and
+      # take disjoint parts of them.
+      train_loader.sampler.set_epoch(ep)
+
     g_prec_meter = AverageMeter()
     g_m_meter = AverageMeter()
     g_dist_ap_meter = AverageMeter()
@@ -432,85 +550,62 @@ def main():
 
     ep_st = time.time()
     step = 0
-    epoch_done = False
-    while not epoch_done:
+    step_st = time.time()
+    for ims_var, labels_t in DevicePrefetcher(train_loader, TVT.device_id):
 
       step += 1
-      step_st = time.time()
-
-      ims, im_names, labels, mirrored, epoch_done = train_set.next_batch()
-
-      ims_var = Variable(TVT(torch.from_numpy(ims).float()))
-      labels_t = TVT(torch.from_numpy(labels).long())
-      labels_var = Variable(labels_t)
-
-      global_feat, local_feat, logits = model_w(ims_var)
-
-      g_loss, p_inds, n_inds, g_dist_ap, g_dist_an, g_dist_mat = global_loss(
-        g_tri_loss, global_feat, labels_t,
-        normalize_feature=cfg.normalize_feature)
-
-      if cfg.l_loss_weight == 0:
-        l_loss = 0
-      elif cfg.local_dist_own_hard_sample:
-        # Let local distance find its own hard samples.
-        l_loss, l_dist_ap, l_dist_an, _ = local_loss(
-          l_tri_loss, local_feat, None, None, labels_t,
-          normalize_feature=cfg.normalize_feature)
-      else:
-        l_loss, l_dist_ap, l_dist_an = local_loss(
-          l_tri_loss, local_feat, p_inds, n_inds, labels_t,
-          normalize_feature=cfg.normalize_feature)
-
-      id_loss = 0
-      if cfg.id_loss_weight > 0:
-        id_loss = id_criterion(logits, labels_var)
 
-      loss = g_loss * cfg.g_loss_weight \
-             + l_loss * cfg.l_loss_weight \
-             + id_loss * cfg.id_loss_weight
+      with torch.cuda.amp.autocast(enabled=cfg.amp):
+        global_feat, local_feat, logits = model_w(ims_var)
+        loss, g_loss, l_loss, id_loss, \
+          g_dist_ap, g_dist_an, l_dist_ap, l_dist_an = compute_loss(
+            global_feat, local_feat, logits, labels_t)
 
-      optimizer.zero_grad()
-      loss.backward()
-      optimizer.step()
+      optimizer.zero_grad(set_to_none=True)
+      scaler.scale(loss).backward()
+      scaler.step(optimizer)
+      scaler.update()
 
       ############
       # Step Log #
       ############
 
-      # precision
-      g_prec = (g_dist_an > g_dist_ap).data.float().mean()
-      # the proportion of triplets that satisfy margin
-      g_m = (g_dist_an > g_dist_ap + cfg.global_margin).data.float().mean()
-      g_d_ap = g_dist_ap.data.mean()
-      g_d_an = g_dist_an.data.mean()
+      # The meters keep these on the device, so they don't synchronize.
+      with torch.no_grad():
+        # precision
+        g_prec = (g_dist_an > g_dist_ap).float().mean()
+        # the proportion of triplets that satisfy margin
+        g_m = (g_dist_an > g_dist_ap + cfg.global_margin).float().mean()
+        g_d_ap = g_dist_ap.mean()
+        g_d_an = g_dist_an.mean()
 
       g_prec_meter.update(g_prec)
       g_m_meter.update(g_m)
       g_dist_ap_meter.update(g_d_ap)
       g_dist_an_meter.update(g_d_an)
-      g_loss_meter.update(to_scalar(g_loss))
+      g_loss_meter.update(g_loss.detach())
 
       if cfg.l_loss_weight > 0:
-        # precision
-        l_prec = (l_dist_an > l_dist_ap).data.float().mean()
-        # the proportion of triplets that satisfy margin
-        l_m = (l_dist_an > l_dist_ap + cfg.local_margin).data.float().mean()
-        l_d_ap = l_dist_ap.data.mean()
-        l_d_an = l_dist_an.data.mean()
+        with torch.no_grad():
+          # precision
+          l_prec = (l_dist_an > l_dist_ap).float().mean()
+          # the proportion of triplets that satisfy margin
+          l_m = (l_dist_an > l_dist_ap + cfg.local_margin).float().mean()
+          l_d_ap = l_dist_ap.mean()
+          l_d_an = l_dist_an.mean()
 
         l_prec_meter.update(l_prec)
         l_m_meter.update(l_m)
         l_dist_ap_meter.update(l_d_ap)
         l_dist_an_meter.update(l_d_an)
-        l_loss_meter.update(to_scalar(l_loss))
+        l_loss_meter.update(l_loss.detach())
 
       if cfg.id_loss_weight > 0:
-        id_loss_meter.update(to_scalar(id_loss))
+        id_loss_meter.update(id_loss.detach())
 
-      loss_meter.update(to_scalar(loss))
+      loss_meter.update(loss.detach())
 
-      if step % cfg.log_steps == 0:
+      if is_main_process and (step % cfg.log_steps == 0):
         time_log = '\tStep {}/Ep {}, {:.2f}s'.format(
           step, ep + 1, time.time() - step_st, )
 
@@ -546,6 +641,13 @@ def main():
               total_loss_log
         print(log)
 
+      # Time of the next step includes waiting for its batch.
+      step_st = time.time()
+
+    # Only the main process logs and saves checkpoint.
+    if not is_main_process:
+      continue
+
     #############
     # Epoch Log #
     #############
@@ -587,45 +689,48 @@ def main():
     # Log to TensorBoard
 
     if cfg.log_to_file:
+      # All scalars go to one event file; tags are grouped by their prefix.
+      scalars = {'loss/global_loss': g_loss_meter.avg,
+                 'loss/local_loss': l_loss_meter.avg,
+                 'loss/id_loss': id_loss_meter.avg,
+                 'loss/loss': loss_meter.avg,
+                 'tri_precision/global_precision': g_prec_meter.avg,
+                 'tri_precision/local_precision': l_prec_meter.avg,
+                 'satisfy_margin/global_satisfy_margin': g_m_meter.avg,
+                 'satisfy_margin/local_satisfy_margin': l_m_meter.avg,
+                 'global_dist/global_dist_ap': g_dist_ap_meter.avg,
+                 'global_dist/global_dist_an': g_dist_an_meter.avg,
+                 'local_dist/local_dist_ap': l_dist_ap_meter.avg,
+                 'local_dist/local_dist_an': l_dist_an_meter.avg}
       if writer is None:
         writer = SummaryWriter(log_dir=osp.join(cfg.exp_dir, 'tensorboard'))
-      writer.add_scalars(
-        'loss',
-        dict(global_loss=g_loss_meter.avg,
-             local_loss=l_loss_meter.avg,
-             id_loss=id_loss_meter.avg,
-             loss=loss_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'tri_precision',
-        dict(global_precision=g_prec_meter.avg,
-             local_precision=l_prec_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'satisfy_margin',
-        dict(global_satisfy_margin=g_m_meter.avg,
-             local_satisfy_margin=l_m_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'global_dist',
-        dict(global_dist_ap=g_dist_ap_meter.avg,
-             global_dist_an=g_dist_an_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'local_dist',
-        dict(local_dist_ap=l_dist_ap_meter.avg,
-             local_dist_an=l_dist_an_meter.avg, ),
-        ep)
+        # Overlay the scalars of each group in one chart, in the
+        # CUSTOM SCALARS tab.
+        groups = dict()
+        for tag in scalars:
+          groups.setdefault(tag.split('/')[0], []).append(tag)
+        writer.add_custom_scalars(
+          {'epoch': {group: ['Multiline', tags]
+                     for group, tags in groups.items()}})
+      for tag, value in scalars.items():
+        writer.add_scalar(tag, value, ep)
+      if (ep + 1) % cfg.tb_flush_epochs == 0:
+        writer.flush()
 
     # save ckpt
     if cfg.log_to_file:
-      save_ckpt(modules_optims, ep + 1, 0, cfg.ckpt_file)
+      ckpt_saver.save(modules_optims, ep + 1, 0, cfg.ckpt_file)
+
+  if writer is not None:
+    writer.close()
+  ckpt_saver.close()
 
   ########
   # Test #
   ########
 
-  test(load_model_weight=False)
+  if is_main_process:
+    test(load_model_weight=False)
 
 
 if __name__ == '__main__':
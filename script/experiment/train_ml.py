@@ -6,16 +6,16 @@ import sys
 sys.path.insert(0, '.')
 
 import torch
-from torch.autograd import Variable
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
 from torch.nn.parallel import DataParallel
+from torch.nn.parallel import parallel_apply
+from torch.cuda.comm import broadcast_coalesced
 
 import time
 import os.path as osp
 from tensorboardX import SummaryWriter
-import threading
 import numpy as np
 import argparse
 
@@ -24,16 +24,17 @@ from aligned_reid.model.Model import Model
 from aligned_reid.model.TripletLoss import TripletLoss
 from aligned_reid.model.loss import global_loss
 from aligned_reid.model.loss import local_loss
+from aligned_reid.model.loss import sum_squared_diff
 
 from aligned_reid.utils.utils import time_str
 from aligned_reid.utils.utils import str2bool
 from aligned_reid.utils.utils import tight_float_str as tfs
 from aligned_reid.utils.utils import may_set_mode
 from aligned_reid.utils.utils import load_ckpt
-from aligned_reid.utils.utils import save_ckpt
+from aligned_reid.utils.utils import AsyncCkptSaver
 from aligned_reid.utils.utils import set_devices_for_ml
+from aligned_reid.utils.utils import TransferVarTensor
 from aligned_reid.utils.utils import AverageMeter
-from aligned_reid.utils.utils import to_scalar
 from aligned_reid.utils.utils import ReDirectSTD
 from aligned_reid.utils.utils import set_seed
 from aligned_reid.utils.utils import adjust_lr_exp
@@ -86,6 +87,9 @@ class Config(object):
     parser.add_argument('--staircase_decay_multiply_factor',
                         type=float, default=0.1)
     parser.add_argument('--total_epochs', type=int, default=150)
+    parser.add_argument('--amp', type=str2bool, default=False)
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--compile_loss', type=str2bool, default=False)
 
     args = parser.parse_known_args()[0]
 
@@ -112,6 +116,9 @@ class Config(object):
     else:
       self.prefetch_threads = 2
 
+    # Number of worker processes loading the training batches.
+    self.num_workers = args.num_workers
+
     self.dataset = args.dataset
     self.trainset_part = args.trainset_part
 
@@ -226,10 +233,24 @@ class Config(object):
     # Number of epochs to train
     self.total_epochs = args.total_epochs
 
+    # Whether to use mixed precision (only on GPU) in forward and backward.
+    # Off by default; the scores reported in README are trained without it.
+    self.amp = args.amp \
+      and all(ids[0] != -1 for ids in self.sys_device_ids)
+
+    # Whether to compile the losses with `torch.compile`, which fuses the
+    # many small ops after the backbone. Compiling takes some minutes at the
+    # first steps.
+    self.compile_loss = args.compile_loss
+
     # How often (in batches) to log. If only need to log the average
     # information for each epoch, set this to a large value, e.g. 1e10.
     self.log_steps = 1e10
 
+    # How often (in epochs) to flush TensorBoard events to disk. Between
+    # flushes, the writer also flushes by itself every two minutes.
+    self.tb_flush_epochs = 10
+
     # Only test and without training.
     self.only_test = args.only_test
 
@@ -285,7 +306,8 @@ class Config(object):
 
 
 class ExtractFeature(object):
-  """A function to be called in the val/test set, to extract features.
+  """A function to be called in the val/test set, to extract features. The
+  features are returned as tensors on the device of the model.
   Args:
     TVT: A callable to transfer images to specific device.
   """
@@ -300,10 +322,9 @@ class ExtractFeature(object):
     # Force all BN layers to use global mean and variance, also disable
     # dropout.
     self.model.eval()
-    ims = Variable(self.TVT(torch.from_numpy(ims).float()))
-    global_feat, local_feat = self.model(ims)[:2]
-    global_feat = global_feat.data.cpu().numpy()
-    local_feat = local_feat.data.cpu().numpy()
+    ims = self.TVT(torch.from_numpy(ims).float())
+    with torch.no_grad():
+      global_feat, local_feat = self.model(ims)[:2]
     # Restore the model to its old train/eval mode.
     self.model.train(old_train_eval_model)
     return global_feat, local_feat
@@ -324,6 +345,9 @@ def main():
 
   if cfg.seed is not None:
     set_seed(cfg.seed)
+  else:
+    # The input size is fixed, so let cudnn pick the fastest algorithms.
+    torch.backends.cudnn.benchmark = True
 
   # Dump the configurations to log.
   import pprint
@@ -337,6 +361,11 @@ def main():
   ###########
 
   train_set = create_dataset(**cfg.train_set_kwargs)
+  train_loader = train_set.get_loader(
+    num_workers=cfg.num_workers,
+    pin_memory=any(TVT.device_id != -1 for TVT in TVTs))
+  # The loader takes the place of the prefetching threads.
+  train_set.stop_prefetching_threads()
 
   test_sets = []
   test_set_names = []
@@ -417,203 +446,182 @@ def main():
   # Training #
   ############
 
-  # Storing things that can be accessed cross threads.
+  # Scales the loss to avoid underflow of half precision gradients.
+  scaler = torch.cuda.amp.GradScaler(enabled=cfg.amp)
+
+  # Checkpoints are written to disk while the next epoch is running.
+  ckpt_saver = AsyncCkptSaver()
 
-  ims_list = [None for _ in range(cfg.num_models)]
-  labels_list = [None for _ in range(cfg.num_models)]
+  # The device of each model, -1 for cpu. Models are run concurrently on
+  # their devices.
+  model_devices = [ids[0] for ids in relative_device_ids]
 
-  done_list1 = [False for _ in range(cfg.num_models)]
-  done_list2 = [False for _ in range(cfg.num_models)]
+  def apply_to_models(funcs, inputs, parallel=True):
+    """Call `funcs[i](*inputs[i])` for all models, concurrently if all models
+    are on gpu and `parallel` is True, otherwise one by one."""
+    if (not parallel) or (-1 in model_devices):
+      return [f(*inp) for f, inp in zip(funcs, inputs)]
+    return parallel_apply(funcs, inputs, devices=model_devices)
 
-  probs_list = [None for _ in range(cfg.num_models)]
-  g_dist_mat_list = [None for _ in range(cfg.num_models)]
-  l_dist_mat_list = [None for _ in range(cfg.num_models)]
+  # Devices used by models, the one of the first model in front.
+  unique_devices = [model_devices[0]] + sorted(
+    set(model_devices) - {model_devices[0]})
 
   # Two phases for each model:
   # 1) forward and single-model loss;
-  # 2) further add mutual loss and backward.
+  # 2) further add mutual loss.
   # The 2nd phase is only ready to start when the 1st is finished for
   # all models.
-  run_event1 = threading.Event()
-  run_event2 = threading.Event()
-
-  # This event is meant to be set to stop threads. However, as I found, with
-  # `daemon` set to true when creating threads, manually stopping is
-  # unnecessary. I guess some main-thread variables required by sub-threads
-  # are destroyed when the main thread ends, thus the sub-threads throw errors
-  # and exit too.
-  # Real reason should be further explored.
-  exit_event = threading.Event()
-
-  # The function to be called by threads.
-  def thread_target(i):
-    while not exit_event.isSet():
-      # If the run event is not set, the thread just waits.
-      if not run_event1.wait(0.001): continue
-
-      ######################################
-      # Phase 1: Forward and Separate Loss #
-      ######################################
-
-      TVT = TVTs[i]
-      model_w = model_ws[i]
-      ims = ims_list[i]
-      labels = labels_list[i]
-      optimizer = optimizers[i]
-
-      ims_var = Variable(TVT(torch.from_numpy(ims).float()))
-      labels_t = TVT(torch.from_numpy(labels).long())
-      labels_var = Variable(labels_t)
-
-      global_feat, local_feat, logits = model_w(ims_var)
-      probs = F.softmax(logits, dim=1)
-      log_probs = F.log_softmax(logits, dim=1)
-
-      g_loss, p_inds, n_inds, g_dist_ap, g_dist_an, g_dist_mat = global_loss(
+
+  ######################################
+  # Phase 1: Forward and Separate Loss #
+  ######################################
+
+  def single_model_loss(global_feat, local_feat, logits, labels_t):
+    """Returns a dict of the losses of one model, and the things required by
+    mutual losses and step log."""
+    # One softmax reduction for both the probabilities and their logarithm.
+    log_probs = F.log_softmax(logits, dim=1)
+    r = dict(probs=log_probs.exp(), log_probs=log_probs)
+
+    r['g_loss'], p_inds, n_inds, r['g_dist_ap'], r['g_dist_an'], \
+      r['g_dist_mat'] = global_loss(
         g_tri_loss, global_feat, labels_t,
         normalize_feature=cfg.normalize_feature)
 
-      if cfg.l_loss_weight == 0:
-        l_loss, l_dist_mat = 0, 0
-      elif cfg.local_dist_own_hard_sample:
-        # Let local distance find its own hard samples.
-        l_loss, l_dist_ap, l_dist_an, l_dist_mat = local_loss(
+    if cfg.l_loss_weight == 0:
+      r['l_loss'], r['l_dist_mat'] = 0, 0
+    elif cfg.local_dist_own_hard_sample:
+      # Let local distance find its own hard samples.
+      r['l_loss'], r['l_dist_ap'], r['l_dist_an'], r['l_dist_mat'] = \
+        local_loss(
           l_tri_loss, local_feat, None, None, labels_t,
           normalize_feature=cfg.normalize_feature)
-      else:
-        l_loss, l_dist_ap, l_dist_an = local_loss(
-          l_tri_loss, local_feat, p_inds, n_inds, labels_t,
-          normalize_feature=cfg.normalize_feature)
-        l_dist_mat = 0
-
-      id_loss = 0
-      if cfg.id_loss_weight > 0:
-        id_loss = id_criterion(logits, labels_var)
-
-      probs_list[i] = probs
-      g_dist_mat_list[i] = g_dist_mat
-      l_dist_mat_list[i] = l_dist_mat
-
-      done_list1[i] = True
-
-      # Wait for event to be set, meanwhile checking if need to exit.
-      while True:
-        phase2_ready = run_event2.wait(0.001)
-        if exit_event.isSet():
-          return
-        if phase2_ready:
-          break
-
-      #####################################
-      # Phase 2: Mutual Loss and Backward #
-      #####################################
-
-      # Probability Mutual Loss (KL Loss)
-      pm_loss = 0
-      if (cfg.num_models > 1) and (cfg.pm_loss_weight > 0):
-        for j in range(cfg.num_models):
-          if j != i:
-            pm_loss += F.kl_div(log_probs, TVT(probs_list[j]).detach(), False)
-        pm_loss /= 1. * (cfg.num_models - 1) * len(ims)
-
-      # Global Distance Mutual Loss (L2 Loss)
-      gdm_loss = 0
-      if (cfg.num_models > 1) and (cfg.gdm_loss_weight > 0):
-        for j in range(cfg.num_models):
-          if j != i:
-            gdm_loss += torch.sum(torch.pow(
-              g_dist_mat - TVT(g_dist_mat_list[j]).detach(), 2))
-        gdm_loss /= 1. * (cfg.num_models - 1) * len(ims) * len(ims)
-
-      # Local Distance Mutual Loss (L2 Loss)
-      ldm_loss = 0
-      if (cfg.num_models > 1) \
-          and cfg.local_dist_own_hard_sample \
-          and (cfg.ldm_loss_weight > 0):
-        for j in range(cfg.num_models):
-          if j != i:
-            ldm_loss += torch.sum(torch.pow(
-              l_dist_mat - TVT(l_dist_mat_list[j]).detach(), 2))
-        ldm_loss /= 1. * (cfg.num_models - 1) * len(ims) * len(ims)
-
-      loss = g_loss * cfg.g_loss_weight \
-             + l_loss * cfg.l_loss_weight \
-             + id_loss * cfg.id_loss_weight \
-             + pm_loss * cfg.pm_loss_weight \
-             + gdm_loss * cfg.gdm_loss_weight \
-             + ldm_loss * cfg.ldm_loss_weight
-
-      optimizer.zero_grad()
-      loss.backward()
-      optimizer.step()
-
-      ##################################
-      # Step Log For One of the Models #
-      ##################################
-
-      # Just record for the first model
-      if i == 0:
-
-        # precision
-        g_prec = (g_dist_an > g_dist_ap).data.float().mean()
-        # the proportion of triplets that satisfy margin
-        g_m = (g_dist_an > g_dist_ap + cfg.global_margin).data.float().mean()
-        g_d_ap = g_dist_ap.data.mean()
-        g_d_an = g_dist_an.data.mean()
-
-        # These meters are outer-scope objects
-        g_prec_meter.update(g_prec)
-        g_m_meter.update(g_m)
-        g_dist_ap_meter.update(g_d_ap)
-        g_dist_an_meter.update(g_d_an)
-        g_loss_meter.update(to_scalar(g_loss))
-
-        if cfg.l_loss_weight > 0:
-          # precision
-          l_prec = (l_dist_an > l_dist_ap).data.float().mean()
-          # the proportion of triplets that satisfy margin
-          l_m = (l_dist_an > l_dist_ap + cfg.local_margin).data.float().mean()
-          l_d_ap = l_dist_ap.data.mean()
-          l_d_an = l_dist_an.data.mean()
-
-          l_prec_meter.update(l_prec)
-          l_m_meter.update(l_m)
-          l_dist_ap_meter.update(l_d_ap)
-          l_dist_an_meter.update(l_d_an)
-          l_loss_meter.update(to_scalar(l_loss))
-
-        if cfg.id_loss_weight > 0:
-          id_loss_meter.update(to_scalar(id_loss))
-
-        if (cfg.num_models > 1) and (cfg.pm_loss_weight > 0):
-          pm_loss_meter.update(to_scalar(pm_loss))
-
-        if (cfg.num_models > 1) and (cfg.gdm_loss_weight > 0):
-          gdm_loss_meter.update(to_scalar(gdm_loss))
-
-        if (cfg.num_models > 1) \
-            and cfg.local_dist_own_hard_sample \
-            and (cfg.ldm_loss_weight > 0):
-          ldm_loss_meter.update(to_scalar(ldm_loss))
-
-        loss_meter.update(to_scalar(loss))
-
-      ###################
-      # End Up One Step #
-      ###################
+    else:
+      r['l_loss'], r['l_dist_ap'], r['l_dist_an'] = local_loss(
+        l_tri_loss, local_feat, p_inds, n_inds, labels_t,
+        normalize_feature=cfg.normalize_feature)
+      r['l_dist_mat'] = 0
+
+    # Computed for all models at once by `id_losses`.
+    r['id_loss'] = 0
+
+    return r
+
+  if cfg.compile_loss:
+    # Compiling is not thread safe, so the compiled loss is called for one
+    # model after another. Its kernels still run concurrently on the devices.
+    single_model_loss = torch.compile(single_model_loss, mode='max-autotune')
+
+  def id_losses(logits_list, labels_ts):
+    """The identification losses of all models, with one cross entropy call
+    for the models on the same device.
+    Args:
+      logits_list: a list of logits, one for one model
+      labels_ts: a list of labels, one for one model
+    Returns:
+      a list of scalar losses, one for one model
+    """
+    losses = [None] * cfg.num_models
+    for d in unique_devices:
+      inds = [i for i, md in enumerate(model_devices) if md == d]
+      if len(inds) == 1:
+        losses[inds[0]] = id_criterion(logits_list[inds[0]], labels_ts[inds[0]])
+        continue
+      loss = F.cross_entropy(
+        torch.cat([logits_list[i] for i in inds]),
+        torch.cat([labels_ts[i] for i in inds]),
+        reduction='none')
+      # Average over the samples of each model.
+      loss = loss.view(len(inds), -1).mean(1)
+      for j, i in enumerate(inds):
+        losses[i] = loss[j]
+    return losses
+
+  ########################
+  # Phase 2: Mutual Loss #
+  ########################
+
+  def share_results(results):
+    """Stack the detached results of all models required by mutual losses,
+    and copy them to each device used by models, once per device.
+    Args:
+      results: the list of dicts returned by `single_model_loss`
+    Returns:
+      a dict mapping device to a dict of stacked tensors, each with shape
+      [num_models, ...]
+    """
+    keys = []
+    if (cfg.num_models > 1) and (cfg.pm_loss_weight > 0):
+      keys.append('probs')
+    if (cfg.num_models > 1) and (cfg.gdm_loss_weight > 0):
+      keys.append('g_dist_mat')
+    if (cfg.num_models > 1) \
+        and cfg.local_dist_own_hard_sample \
+        and (cfg.ldm_loss_weight > 0):
+      keys.append('l_dist_mat')
+    if len(keys) == 0:
+      return {d: {} for d in unique_devices}
+    # Stack on the device of the first model.
+    stacks = [torch.stack([TVTs[0](r[k].detach()) for r in results])
+              for k in keys]
+    if -1 in unique_devices:
+      copies = [[TransferVarTensor(d)(t) for t in stacks]
+                for d in unique_devices]
+    else:
+      copies = broadcast_coalesced(stacks, unique_devices)
+    return {d: dict(zip(keys, c)) for d, c in zip(unique_devices, copies)}
+
+  def mutual_loss(i, results, shared, pm_norm, dm_norm):
+    """Returns the mutual losses between model `i` and other models, summed
+    over samples and other models, and the total loss of model `i`.
+    Args:
+      results: the list of dicts returned by `single_model_loss`
+      shared: the dict returned by `share_results`
+      pm_norm: normalizing factor of the probability mutual loss
+      dm_norm: normalizing factor of the distance mutual losses
+    """
+    r = results[i]
+    local_shared = shared[model_devices[i]]
+
+    def others(stacked):
+      """Results of all models except model `i`."""
+      return torch.cat([stacked[:i], stacked[i + 1:]])
+
+    # Probability Mutual Loss (KL Loss)
+    pm_loss = 0
+    if (cfg.num_models > 1) and (cfg.pm_loss_weight > 0):
+      # shape [num_models - 1, N, num_classes]
+      probs = others(local_shared['probs'])
+      # KL divergence to all other models in one reduction.
+      pm_loss = F.kl_div(
+        r['log_probs'].expand_as(probs), probs, reduction='sum')
+
+    # Global Distance Mutual Loss (L2 Loss)
+    gdm_loss = 0
+    if (cfg.num_models > 1) and (cfg.gdm_loss_weight > 0):
+      # shape [num_models - 1, N, N]
+      g_dist_mats = others(local_shared['g_dist_mat'])
+      # L2 distance to all other models in one reduction.
+      gdm_loss = sum_squared_diff(r['g_dist_mat'], g_dist_mats)
 
-      run_event1.clear()
-      run_event2.clear()
+    # Local Distance Mutual Loss (L2 Loss)
+    ldm_loss = 0
+    if (cfg.num_models > 1) \
+        and cfg.local_dist_own_hard_sample \
+        and (cfg.ldm_loss_weight > 0):
+      # shape [num_models - 1, N, N]
+      l_dist_mats = others(local_shared['l_dist_mat'])
+      ldm_loss = sum_squared_diff(r['l_dist_mat'], l_dist_mats)
 
-      done_list2[i] = True
+    loss = r['g_loss'] * cfg.g_loss_weight \
+           + r['l_loss'] * cfg.l_loss_weight \
+           + r['id_loss'] * cfg.id_loss_weight \
+           + pm_loss * (cfg.pm_loss_weight * pm_norm) \
+           + gdm_loss * (cfg.gdm_loss_weight * dm_norm) \
+           + ldm_loss * (cfg.ldm_loss_weight * dm_norm)
 
-  threads = []
-  for i in range(cfg.num_models):
-    thread = threading.Thread(target=thread_target, args=(i,))
-    # Set the thread in daemon mode, so that the main program ends normally.
-    thread.daemon = True
-    thread.start()
-    threads.append(thread)
+    return pm_loss, gdm_loss, ldm_loss, loss
 
   start_ep = resume_ep if cfg.resume else 0
   for ep in range(start_ep, cfg.total_epochs):
@@ -637,8 +645,6 @@ def main():
 
     may_set_mode(modules_optims, 'train')
 
-    epoch_done = False
-
     g_prec_meter = AverageMeter()
     g_m_meter = AverageMeter()
     g_dist_ap_meter = AverageMeter()
@@ -664,26 +670,112 @@ def main():
 
     ep_st = time.time()
     step = 0
-    while not epoch_done:
+    for ims, labels in train_loader:
 
       step += 1
       step_st = time.time()
 
-      ims, im_names, labels, mirrored, epoch_done = train_set.next_batch()
+      # Copy the pinned batch once to each device used by models; models on
+      # the same device share it.
+      batches = dict()
+      for d in unique_devices:
+        batches[d] = (ims, labels) if d == -1 else \
+          (ims.cuda(d, non_blocking=True), labels.cuda(d, non_blocking=True))
+      ims_vars = [batches[d][0] for d in model_devices]
+      labels_ts = [batches[d][1] for d in model_devices]
+
+      # The mutual losses are averaged over samples and other models. These
+      # factors are folded into the loss weights.
+      N = len(ims)
+      num_others = max(cfg.num_models - 1, 1)
+      pm_norm = 1. / (num_others * N)
+      dm_norm = 1. / (num_others * N * N)
+
+      with torch.cuda.amp.autocast(enabled=cfg.amp):
+        outputs = apply_to_models(
+          model_ws, [(ims_var,) for ims_var in ims_vars])
+        results = apply_to_models(
+          [single_model_loss] * cfg.num_models,
+          [tuple(output) + (labels_t,)
+           for output, labels_t in zip(outputs, labels_ts)],
+          parallel=not cfg.compile_loss)
+        if cfg.id_loss_weight > 0:
+          for r, id_loss in zip(
+              results, id_losses([o[2] for o in outputs], labels_ts)):
+            r['id_loss'] = id_loss
+        shared = share_results(results)
+        mutual_results = apply_to_models(
+          [mutual_loss] * cfg.num_models,
+          [(i, results, shared, pm_norm, dm_norm)
+           for i in range(cfg.num_models)])
+
+      # The mutual losses only use detached results of other models, so the
+      # gradients of each model come from its own loss. One backward pass over
+      # the sum of all losses computes the gradients of all models.
+      total_loss = sum([TVTs[0](loss) for _, _, _, loss in mutual_results])
+
+      for optimizer in optimizers:
+        optimizer.zero_grad(set_to_none=True)
+      scaler.scale(total_loss).backward()
+      for optimizer in optimizers:
+        scaler.step(optimizer)
+      scaler.update()
 
-      for i in range(cfg.num_models):
-        ims_list[i] = ims
-        labels_list[i] = labels
-        done_list1[i] = False
-        done_list2[i] = False
+      ##################################
+      # Step Log For One of the Models #
+      ##################################
 
-      run_event1.set()
-      # Waiting for phase 1 done
-      while not all(done_list1): continue
+      # Just record for the first model
+      r = results[0]
+      pm_loss, gdm_loss, ldm_loss, loss = mutual_results[0]
 
-      run_event2.set()
-      # Waiting for phase 2 done
-      while not all(done_list2): continue
+      # The meters keep these on the device, so they don't synchronize.
+      with torch.no_grad():
+        # precision
+        g_prec = (r['g_dist_an'] > r['g_dist_ap']).float().mean()
+        # the proportion of triplets that satisfy margin
+        g_m = (r['g_dist_an'] > r['g_dist_ap'] + cfg.global_margin) \
+          .float().mean()
+        g_d_ap = r['g_dist_ap'].mean()
+        g_d_an = r['g_dist_an'].mean()
+
+      g_prec_meter.update(g_prec)
+      g_m_meter.update(g_m)
+      g_dist_ap_meter.update(g_d_ap)
+      g_dist_an_meter.update(g_d_an)
+      g_loss_meter.update(r['g_loss'].detach())
+
+      if cfg.l_loss_weight > 0:
+        with torch.no_grad():
+          # precision
+          l_prec = (r['l_dist_an'] > r['l_dist_ap']).float().mean()
+          # the proportion of triplets that satisfy margin
+          l_m = (r['l_dist_an'] > r['l_dist_ap'] + cfg.local_margin) \
+            .float().mean()
+          l_d_ap = r['l_dist_ap'].mean()
+          l_d_an = r['l_dist_an'].mean()
+
+        l_prec_meter.update(l_prec)
+        l_m_meter.update(l_m)
+        l_dist_ap_meter.update(l_d_ap)
+        l_dist_an_meter.update(l_d_an)
+        l_loss_meter.update(r['l_loss'].detach())
+
+      if cfg.id_loss_weight > 0:
+        id_loss_meter.update(r['id_loss'].detach())
+
+      if (cfg.num_models > 1) and (cfg.pm_loss_weight > 0):
+        pm_loss_meter.update(pm_loss.detach() * pm_norm)
+
+      if (cfg.num_models > 1) and (cfg.gdm_loss_weight > 0):
+        gdm_loss_meter.update(gdm_loss.detach() * dm_norm)
+
+      if (cfg.num_models > 1) \
+          and cfg.local_dist_own_hard_sample \
+          and (cfg.ldm_loss_weight > 0):
+        ldm_loss_meter.update(ldm_loss.detach() * dm_norm)
+
+      loss_meter.update(loss.detach())
 
       ############
       # Step Log #
@@ -802,42 +894,44 @@ def main():
     # Log to TensorBoard
 
     if cfg.log_to_file:
+      # All scalars go to one event file; tags are grouped by their prefix.
+      scalars = {'loss/global_loss': g_loss_meter.avg,
+                 'loss/local_loss': l_loss_meter.avg,
+                 'loss/id_loss': id_loss_meter.avg,
+                 'loss/pm_loss': pm_loss_meter.avg,
+                 'loss/gdm_loss': gdm_loss_meter.avg,
+                 'loss/ldm_loss': ldm_loss_meter.avg,
+                 'loss/loss': loss_meter.avg,
+                 'tri_precision/global_precision': g_prec_meter.avg,
+                 'tri_precision/local_precision': l_prec_meter.avg,
+                 'satisfy_margin/global_satisfy_margin': g_m_meter.avg,
+                 'satisfy_margin/local_satisfy_margin': l_m_meter.avg,
+                 'global_dist/global_dist_ap': g_dist_ap_meter.avg,
+                 'global_dist/global_dist_an': g_dist_an_meter.avg,
+                 'local_dist/local_dist_ap': l_dist_ap_meter.avg,
+                 'local_dist/local_dist_an': l_dist_an_meter.avg}
       if writer is None:
         writer = SummaryWriter(log_dir=osp.join(cfg.exp_dir, 'tensorboard'))
-      writer.add_scalars(
-        'loss',
-        dict(global_loss=g_loss_meter.avg,
-             local_loss=l_loss_meter.avg,
-             id_loss=id_loss_meter.avg,
-             pm_loss=pm_loss_meter.avg,
-             gdm_loss=gdm_loss_meter.avg,
-             ldm_loss=ldm_loss_meter.avg,
-             loss=loss_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'tri_precision',
-        dict(global_precision=g_prec_meter.avg,
-             local_precision=l_prec_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'satisfy_margin',
-        dict(global_satisfy_margin=g_m_meter.avg,
-             local_satisfy_margin=l_m_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'global_dist',
-        dict(global_dist_ap=g_dist_ap_meter.avg,
-             global_dist_an=g_dist_an_meter.avg, ),
-        ep)
-      writer.add_scalars(
-        'local_dist',
-        dict(local_dist_ap=l_dist_ap_meter.avg,
-             local_dist_an=l_dist_an_meter.avg, ),
-        ep)
+        # Overlay the scalars of each group in one chart, in the
+        # CUSTOM SCALARS tab.
+        groups = dict()
+        for tag in scalars:
+          groups.setdefault(tag.split('/')[0], []).append(tag)
+        writer.add_custom_scalars(
+          {'epoch': {group: ['Multiline', tags]
+                     for group, tags in groups.items()}})
+      for tag, value in scalars.items():
+        writer.add_scalar(tag, value, ep)
+      if (ep + 1) % cfg.tb_flush_epochs == 0:
+        writer.flush()
 
     # save ckpt
     if cfg.log_to_file:
-      save_ckpt(modules_optims, ep + 1, 0, cfg.ckpt_file)
+      ckpt_saver.save(modules_optims, ep + 1, 0, cfg.ckpt_file)
+
+  if writer is not None:
+    writer.close()
+  ckpt_saver.close()
 
   ########
   # Test #